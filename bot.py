@@ -1,97 +1,413 @@
 import os
 import asyncio
 import logging
-from typing import Any, Dict
+import random
+import signal
+from typing import Any, Dict, List, Optional, Set
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import CommandStart
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import aiohttp
+from aiohttp import web
+import orjson
+from cachetools import TTLCache
 
 from dispatcher import MessageDispatcher
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SERVER_URL = os.getenv("SERVER_URL", "http://localhost:8000")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+_WEBHOOK_URL = SERVER_URL.rstrip("/") + "/user/webhook"
+_BATCH_URL = _WEBHOOK_URL + "/batch"
+_HEALTH_URL = SERVER_URL.rstrip("/") + "/healthz"
+SERVER_BATCHING = os.getenv("SERVER_BATCHING", "").lower() in ("1", "true", "yes")
+MAX_BATCH = 64
+BATCH_DELAY = 0.010
+MAX_INFLIGHT = 256
+SERVER_POOL_SIZE = 32
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.05
+# Keeps a retried update well within Telegram's 30s handler budget.
+RETRY_BUDGET = 25
+_JSON_HEADERS = {"Content-Type": "application/json"}
+RESPONSE_CACHE_SIZE = 10_000
+RESPONSE_CACHE_TTL = 30
+_HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=2, sock_connect=2, sock_read=10)
 
 logging.basicConfig(level=logging.INFO)
 
 router = Router()
-dispatcher: MessageDispatcher | None = None
+_http: Optional[aiohttp.ClientSession] = None
+_batch: Optional["BatchClient"] = None
+_inflight = asyncio.Semaphore(MAX_INFLIGHT)
+_send_sem = asyncio.Semaphore(SERVER_POOL_SIZE)
+_background_tasks: Set[asyncio.Task] = set()
+_closing = False
+_resp_cache: TTLCache[tuple, Dict[str, Any]] = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
 
 
-async def send_to_server(payload: Dict[str, Any]) -> Dict[str, Any]:
-    """Send payload to ServidorGame and return the JSON response."""
-    url = SERVER_URL.rstrip("/") + "/user/webhook"
+async def post_json(url: str, body: Any) -> Any:
+    """POST ``body`` as JSON to ``url`` and return the decoded JSON reply.
+
+    Connection failures, connect timeouts and 5xx replies are retried with
+    exponential backoff and jitter. The whole call, including waiting for a
+    connection slot, is capped at ``RETRY_BUDGET`` seconds; an empty dict is
+    returned once the attempts or the budget are exhausted.
+    """
+    if _http is None:
+        logging.error("HTTP session is not initialised")
+        return {}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RETRY_BUDGET
+    attempts = _post_with_retries(url, orjson.dumps(body), deadline)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as resp:
-                if resp.content_type == "application/json":
-                    return await resp.json()
-                return {}
-    except Exception:
-        logging.exception("Failed to reach server")
+        return await asyncio.wait_for(attempts, RETRY_BUDGET)
+    except asyncio.TimeoutError:
+        logging.error("Giving up on server after %ss", RETRY_BUDGET)
+        return {}
+
+
+async def _post_with_retries(url: str, data: bytes, deadline: float) -> Any:
+    loop = asyncio.get_running_loop()
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            async with _send_sem, _http.post(url, data=data, headers=_JSON_HEADERS) as resp:
+                if resp.status < 500:
+                    if resp.content_type == "application/json":
+                        return await resp.json(loads=orjson.loads)
+                    return {}
+                logging.warning(
+                    "Server replied %s (attempt %d/%d)", resp.status, attempt, RETRY_ATTEMPTS
+                )
+        except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as exc:
+            logging.warning(
+                "Failed to connect to server (attempt %d/%d): %s", attempt, RETRY_ATTEMPTS, exc
+            )
+        except Exception:
+            logging.exception("Failed to reach server")
+            return {}
+        if attempt < RETRY_ATTEMPTS:
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1) + random.random() * RETRY_BASE_DELAY
+            if loop.time() + delay >= deadline:
+                break
+            await asyncio.sleep(delay)
+    logging.error("Giving up on server after %d attempts", attempt)
+    return {}
+
+
+class BatchClient:
+    """Coalesce concurrent webhook payloads into a single batched POST."""
+
+    def __init__(self, max_batch: int = MAX_BATCH, max_delay: float = BATCH_DELAY) -> None:
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue[tuple[Dict[str, Any], asyncio.Future]] = asyncio.Queue()
+        self._worker_task: Optional[asyncio.Task] = None
+        self._send_tasks: Set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._worker_task = asyncio.create_task(self._worker())
+
+    async def stop(self) -> None:
+        if self._worker_task:
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+            self._worker_task = None
+        if self._send_tasks:
+            await asyncio.gather(*self._send_tasks, return_exceptions=True)
+        while not self.queue.empty():
+            _, fut = self.queue.get_nowait()
+            if not fut.done():
+                fut.set_result({})
+
+    async def submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((payload, fut))
+        return await fut
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[tuple[Dict[str, Any], asyncio.Future]] = []
+            try:
+                batch.append(await self.queue.get())
+                deadline = loop.time() + self.max_delay
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                _settle(batch)
+                raise
+
+            # Send in the background so the next batch can be collected while
+            # this one is in flight; post_json bounds the concurrency.
+            task = asyncio.create_task(self._send(batch))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, batch: List[tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        try:
+            reply = await post_json(_BATCH_URL, {"batch": [p for p, _ in batch]})
+            results = reply.get("batch") if isinstance(reply, dict) else None
+            if not isinstance(results, list):
+                logging.error("Malformed batch reply from server")
+                results = []
+            for i, (_, fut) in enumerate(batch):
+                if fut.done():
+                    continue
+                result = results[i] if i < len(results) else None
+                fut.set_result(result if isinstance(result, dict) else {})
+        finally:
+            _settle(batch)
+
+
+def _settle(batch: List[tuple[Dict[str, Any], asyncio.Future]]) -> None:
+    """Resolve any still-pending futures in ``batch`` with an empty reply."""
+    for _, fut in batch:
+        if not fut.done():
+            fut.set_result({})
+
+
+async def warm_up() -> None:
+    """Open a keep-alive connection to the server before updates arrive."""
+    if _http is None:
+        return
+    try:
+        async with _http.get(_HEALTH_URL) as resp:
+            await resp.read()
+    except Exception as exc:
+        logging.warning("Server warm-up failed: %s", exc)
+
+
+async def send_to_server(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Send payload to ServidorGame and return the JSON response.
+
+    Replies the server marks with ``"cacheable": true`` are remembered for a
+    short while and reused for identical updates from the same user.
+    """
+    key = (payload["user_id"], payload["message_type"], payload["message_content"])
+    cached = _resp_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if _batch is not None:
+        response = await _batch.submit(payload)
+    else:
+        response = await post_json(_WEBHOOK_URL, payload)
+    if not isinstance(response, dict):
         return {}
 
+    if response.get("cacheable") and payload["user_id"] is not None:
+        _resp_cache[key] = response
+    else:
+        _resp_cache.pop(key, None)
+    return response
+
+
+
+def dump_event(event: Message | CallbackQuery) -> orjson.Fragment:
+    """Serialise the complete ``event`` for the server.
+
+    The JSON is produced directly by pydantic and embedded verbatim when the
+    payload is encoded with orjson, so no intermediate dict is built.
+    """
+    return orjson.Fragment(event.model_dump_json())
 
 
 async def build_message_payload(message: Message) -> Dict[str, Any]:
+    user = message.from_user
     return {
-        "user_id": message.from_user.id if message.from_user else None,
-        "username": message.from_user.username if message.from_user else None,
+        "user_id": user.id if user else None,
+        "username": user.username if user else None,
         "message_type": message.content_type,
         "message_content": message.text or message.caption,
-        "data": message.model_dump(mode="json"),
+        "data": dump_event(message),
     }
 
 
 async def build_callback_payload(callback: CallbackQuery) -> Dict[str, Any]:
+    user = callback.from_user
     return {
-        "user_id": callback.from_user.id if callback.from_user else None,
-        "username": callback.from_user.username if callback.from_user else None,
+        "user_id": user.id if user else None,
+        "username": user.username if user else None,
         "message_type": "callback_query",
         "message_content": callback.data,
-        "data": callback.model_dump(mode="json"),
+        "data": dump_event(callback),
     }
 
 
+async def _process(
+    dispatcher: MessageDispatcher, event: Message | CallbackQuery, payload: Dict[str, Any]
+) -> None:
+    """Forward ``payload`` to the server and dispatch the resulting action."""
+    async with _inflight:
+        try:
+            response = await send_to_server(payload)
+            await dispatcher.dispatch(event, response)
+        except Exception:
+            logging.exception("Failed to process update")
+
+
+async def _drain_background_tasks() -> None:
+    """Stop accepting new updates and wait for every spawned task to finish."""
+    global _closing
+    _closing = True
+    while _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+
+
+def _spawn(
+    dispatcher: MessageDispatcher, event: Message | CallbackQuery, payload: Dict[str, Any]
+) -> Optional[asyncio.Task]:
+    if _closing:
+        logging.warning("Dropping update received during shutdown")
+        return None
+    task = asyncio.create_task(_process(dispatcher, event, payload))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
 @router.message(CommandStart())
-async def start_handler(message: Message, bot: Bot) -> None:
+async def start_handler(message: Message, message_dispatcher: MessageDispatcher) -> None:
+    # Wait for the reply within this update's handler rather than returning
+    # early; the task is still tracked so shutdown drains it.
     payload = await build_message_payload(message)
-    response = await send_to_server(payload)
-    if dispatcher:
-        await dispatcher.dispatch(message, response)
+    task = _spawn(message_dispatcher, message, payload)
+    if task is not None:
+        await task
 
 
 @router.message()
-async def handle_all_messages(message: Message, bot: Bot) -> None:
+async def handle_all_messages(message: Message, message_dispatcher: MessageDispatcher) -> None:
     payload = await build_message_payload(message)
-    response = await send_to_server(payload)
-    if dispatcher:
-        await dispatcher.dispatch(message, response)
+    _spawn(message_dispatcher, message, payload)
 
 
 @router.callback_query()
-async def handle_callbacks(callback: CallbackQuery, bot: Bot) -> None:
+async def handle_callbacks(callback: CallbackQuery, message_dispatcher: MessageDispatcher) -> None:
+    if _closing:
+        return
+    # Acknowledge first so the spinner stops while the payload is being built.
+    # Yield once so the answer task actually starts before dump_event runs.
+    answer = asyncio.create_task(callback.answer())
+    await asyncio.sleep(0)
     payload = await build_callback_payload(callback)
-    response = await send_to_server(payload)
-    if dispatcher:
-        await dispatcher.dispatch(callback, response)
+    _spawn(message_dispatcher, callback, payload)
+    try:
+        await answer
+    except Exception:
+        logging.exception("Failed to answer callback query")
 
 
-def main() -> None:
+async def _wait_for_stop_signal() -> None:
+    """Block until SIGINT or SIGTERM is received."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    signals = (signal.SIGINT, signal.SIGTERM)
+    installed = []
+    for sig in signals:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: Ctrl+C still interrupts via KeyboardInterrupt.
+            continue
+        installed.append(sig)
+    try:
+        await stop.wait()
+    finally:
+        for sig in installed:
+            loop.remove_signal_handler(sig)
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Receive updates pushed by Telegram instead of long-polling for them."""
+    app = web.Application()
+    # Registered first so pending updates finish before the request handler's
+    # shutdown hook closes the bot session.
+    app.on_shutdown.append(lambda _app: _drain_background_tasks())
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(
+        app, path=WEBHOOK_PATH
+    )
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        site = web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT)
+        await site.start()
+        await bot.set_webhook(
+            WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        await _wait_for_stop_signal()
+    finally:
+        await runner.cleanup()
+
+
+async def main() -> None:
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN environment variable is required")
 
-    dp = Dispatcher(storage=MemoryStorage())
+    bot = Bot(BOT_TOKEN)
+    # Handlers receive this as the ``message_dispatcher`` argument; aiogram
+    # already injects its own Dispatcher under the ``dispatcher`` key.
+    dp = Dispatcher(storage=MemoryStorage(), message_dispatcher=MessageDispatcher(bot))
     dp.include_router(router)
 
-    bot = Bot(BOT_TOKEN)
-    global dispatcher
-    dispatcher = MessageDispatcher(bot)
+    global _http, _batch
+    _http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=SERVER_POOL_SIZE,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+        ),
+        timeout=_HTTP_TIMEOUT,
+    )
+    await warm_up()
 
-    dp.run_polling(bot)
+    if SERVER_BATCHING:
+        _batch = BatchClient()
+        _batch.start()
+
+    try:
+        if WEBHOOK_BASE_URL:
+            await run_webhook(dp, bot)
+        else:
+            # A webhook left over from an earlier run makes getUpdates fail.
+            await bot.delete_webhook()
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await _drain_background_tasks()
+        await bot.session.close()
+        if _batch is not None:
+            await _batch.stop()
+            _batch = None
+        await _http.close()
+        _http = None
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -1,7 +1,11 @@
+import asyncio
+import functools
 import logging
-from typing import Any, Dict, Callable, Awaitable, Optional
+from types import MappingProxyType
+from typing import Any, Dict, Callable, Awaitable, List, Mapping, Optional
 
 from aiogram import Bot
+from cachetools import LRUCache
 from aiogram.types import (
     Message,
     CallbackQuery,
@@ -11,93 +15,146 @@ from aiogram.types import (
 
 logger = logging.getLogger(__name__)
 
+MAX_TRACKED_CHATS = 100_000
+_EMPTY: Mapping[str, Any] = MappingProxyType({})
+
+
+@functools.lru_cache(maxsize=512)
+def _build_markup(spec: tuple[tuple[str, str], ...]) -> InlineKeyboardMarkup:
+    """Build a one-button-per-row keyboard from ``(text, callback_data)`` pairs."""
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=t, callback_data=c)] for t, c in spec]
+    )
+
+
+def _markup_from(buttons_cfg: Any) -> Optional[InlineKeyboardMarkup]:
+    if not buttons_cfg:
+        return None
+    return _build_markup(
+        tuple((btn.get("text", ""), btn.get("callback_data", "")) for btn in buttons_cfg)
+    )
+
 
 class MessageDispatcher:
     """Dispatch actions from the server to Telegram API calls."""
 
     def __init__(self, bot: Bot) -> None:
         self.bot = bot
-        self.handlers: Dict[str, Callable[[Message, Dict[str, Any]], Awaitable[Optional[Message]]]] = {
+        self.handlers: Dict[str, Callable[[Message, int, Mapping[str, Any]], Awaitable[Optional[Message]]]] = {
             "reply": self._reply,
             "show_menu": self._show_menu,
             "send_photo": self._send_photo,
             "edit_message": self._edit_message,
             "delete_message": self._delete_message,
         }
-        self._last_bot_message: Dict[int, Message] = {}
+        self._last_bot_message: LRUCache[int, Message] = LRUCache(maxsize=MAX_TRACKED_CHATS)
 
     async def dispatch(self, event: Message | CallbackQuery, response: Dict[str, Any]) -> None:
-        action = response.get("action")
-        data = response.get("data", {})
-        if not action:
+        actions = response.get("actions")
+        many = isinstance(actions, list)
+        if not many and not response.get("action"):
             return
 
+        message = event.message if isinstance(event, CallbackQuery) else event
+        if message is None:
+            # Inline-mode callbacks carry no message to act on.
+            logger.warning("Cannot dispatch server actions: update has no message")
+            return
+
+        chat_id = message.chat.id
+        if many:
+            await self._dispatch_many(message, chat_id, actions)
+            return
+
+        sent = await self._run(message, chat_id, response)
+        if sent:
+            self._last_bot_message[chat_id] = sent
+
+    async def _run(self, message: Message, chat_id: int, spec: Mapping[str, Any]) -> Optional[Message]:
+        action = spec.get("action")
+        if not action:
+            return None
+
         handler = self.handlers.get(action)
         if not handler:
             logger.warning("Unknown action received from server: %s", action)
-            return
+            return None
 
-        message = event.message if isinstance(event, CallbackQuery) else event
-        sent = await handler(message, data)
-        if sent:
-            self._last_bot_message[message.chat.id] = sent
+        data = spec.get("data") or _EMPTY
+        return await handler(message, chat_id, data)
+
+    async def _dispatch_many(self, message: Message, chat_id: int, actions: List[Any]) -> None:
+        """Run independent actions concurrently.
+
+        An action marked ``"sequential": True`` waits for everything before it
+        and finishes before anything after it starts.
+        """
+        pending: List[Mapping[str, Any]] = []
+        for spec in actions:
+            if not isinstance(spec, dict):
+                continue
+            if spec.get("sequential"):
+                await self._gather(message, chat_id, pending)
+                pending = []
+                await self._gather(message, chat_id, [spec])
+            else:
+                pending.append(spec)
+        await self._gather(message, chat_id, pending)
+
+    async def _gather(self, message: Message, chat_id: int, specs: List[Mapping[str, Any]]) -> None:
+        if not specs:
+            return
+        results = await asyncio.gather(
+            *(self._run(message, chat_id, spec) for spec in specs), return_exceptions=True
+        )
+        for spec, result in zip(specs, results):
+            if isinstance(result, BaseException):
+                logger.error("Action %s failed", spec.get("action"), exc_info=result)
+            elif result:
+                self._last_bot_message[chat_id] = result
 
-    async def _reply(self, message: Message, data: Dict[str, Any]) -> Optional[Message]:
+    async def _reply(self, message: Message, chat_id: int, data: Mapping[str, Any]) -> Optional[Message]:
         text = data.get("text", "")
         return await message.answer(text)
 
-    async def _show_menu(self, message: Message, data: Dict[str, Any]) -> Optional[Message]:
-        buttons_cfg = data.get("buttons", [])
-        markup: Optional[InlineKeyboardMarkup] = None
-        if buttons_cfg:
-            keyboard = [
-                [InlineKeyboardButton(text=btn.get("text", ""), callback_data=btn.get("callback_data", ""))]
-                for btn in buttons_cfg
-            ]
-            markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    async def _show_menu(self, message: Message, chat_id: int, data: Mapping[str, Any]) -> Optional[Message]:
+        markup = _markup_from(data.get("buttons"))
         return await message.answer(data.get("text", ""), reply_markup=markup)
 
-    async def _send_photo(self, message: Message, data: Dict[str, Any]) -> Optional[Message]:
+    async def _send_photo(self, message: Message, chat_id: int, data: Mapping[str, Any]) -> Optional[Message]:
         return await self.bot.send_photo(
-            chat_id=message.chat.id,
+            chat_id=chat_id,
             photo=data.get("photo"),
             caption=data.get("caption"),
         )
 
-    async def _edit_message(self, message: Message, data: Dict[str, Any]) -> Optional[Message]:
+    async def _edit_message(self, message: Message, chat_id: int, data: Mapping[str, Any]) -> Optional[Message]:
         message_id = data.get("message_id")
         if not message_id:
-            last = self._last_bot_message.get(message.chat.id)
+            last = self._last_bot_message.get(chat_id)
             if last:
                 message_id = last.message_id
         if not message_id:
             return None
-        buttons_cfg = data.get("buttons")
-        markup: Optional[InlineKeyboardMarkup] = None
-        if buttons_cfg:
-            keyboard = [
-                [InlineKeyboardButton(text=btn.get("text", ""), callback_data=btn.get("callback_data", ""))]
-                for btn in buttons_cfg
-            ]
-            markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+        markup = _markup_from(data.get("buttons"))
         await self.bot.edit_message_text(
-            chat_id=message.chat.id,
+            chat_id=chat_id,
             message_id=message_id,
             text=data.get("text", ""),
             reply_markup=markup,
         )
         return None
 
-    async def _delete_message(self, message: Message, data: Dict[str, Any]) -> Optional[Message]:
+    async def _delete_message(self, message: Message, chat_id: int, data: Mapping[str, Any]) -> Optional[Message]:
         message_id = data.get("message_id")
         if not message_id:
-            last = self._last_bot_message.pop(message.chat.id, None)
+            last = self._last_bot_message.pop(chat_id, None)
             if last:
                 message_id = last.message_id
         if not message_id:
             return None
         try:
-            await self.bot.delete_message(chat_id=message.chat.id, message_id=message_id)
+            await self.bot.delete_message(chat_id=chat_id, message_id=message_id)
         except Exception:
             logger.exception("Failed to delete message")
         return None